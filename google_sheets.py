@@ -1,16 +1,67 @@
-from typing import Optional
-import os.path
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Iterator, Optional
+from contextlib import contextmanager
+from functools import lru_cache
+import logging
 import re
+import threading
 from enum import Enum
 
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build, Resource
 from googleapiclient.errors import HttpError
 
+if TYPE_CHECKING:
+    from google.oauth2.credentials import Credentials
+    from googleapiclient.discovery import Resource
+
+
+logger = logging.getLogger(__name__)
+
+NUM_RETRIES = 5
+
+SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets.readonly',
+    'https://www.googleapis.com/auth/spreadsheets'
+]
+
+_RANGE_PATTERN = re.compile(
+    r"^(?:.*!)?\$?([A-Z]+)\$?([0-9]+)(?::\$?([A-Z]*)\$?([0-9]*))?$"
+)
+
+
+@lru_cache(maxsize=4096)
+def _column_index(letters: str) -> int:
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - 64
+
+    return index
+
+
+@lru_cache(maxsize=1024)
+def _parse_range(
+    range: str
+) -> tuple[int, int, Optional[int], Optional[int]]:
+    match = _RANGE_PATTERN.match(range)
+
+    if match is None:
+        raise ValueError(f"Invalid range: {range}")
 
-class BorderStyle(Enum):
+    start_column, start_row, end_column, end_row = match.groups()
+
+    # A single cell ("B2") spans exactly one row and one column
+    if end_column is None:
+        end_column, end_row = start_column, start_row
+
+    return (
+        int(start_row) - 1,
+        _column_index(start_column) - 1,
+        int(end_row) if end_row else None,
+        _column_index(end_column) if end_column else None
+    )
+
+
+class BorderStyle(str, Enum):
     STYLE_UNSPECIFIED = "STYLE_UNSPECIFIED"
     DOTTED = "DOTTED"
     DASHED = "DASHED"
@@ -23,84 +74,135 @@ class BorderStyle(Enum):
 
 class GoogleSheets:
 
+    _credentials: Optional[Credentials] = None
+    _credentials_lock = threading.Lock()
+    # httplib2 is not thread-safe, so the service and its resources are
+    # looked up per thread (and shared by every instance in that thread)
+    # instead of being cached on the instance
+    _thread_local = threading.local()
+
     def __init__(self, sheet_id: str) -> None:
         self.sheet_id: str = sheet_id
-        self.service: Resource = self._load_service()
+        self._sheetpage_id_cache: dict[str, int] = {}
+        # batch() queues are per thread, so a batch open in one thread
+        # never captures calls made on this instance by another thread
+        self._batch_state = threading.local()
 
 
-    def _load_service(self) -> Optional[Resource]:
-        creds = None
+    @property
+    def _batch_queue(self) -> Optional[list[tuple[str, list[dict]]]]:
+        return getattr(self._batch_state, "queue", None)
 
-        SCOPES = [
-            'https://www.googleapis.com/auth/spreadsheets.readonly',
-            'https://www.googleapis.com/auth/spreadsheets'
-        ]
 
-        if os.path.exists('token.json'):
-            creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+    @_batch_queue.setter
+    def _batch_queue(self, queue: Optional[list[tuple[str, list[dict]]]]) -> None:
+        self._batch_state.queue = queue
 
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    'client_secret.json', SCOPES)
-                creds = flow.run_local_server(port=0)
-            
-            with open('token.json', 'w') as token:
-                token.write(creds.to_json())
 
-        try:
-            return build('sheets', 'v4', credentials=creds)
-        except HttpError as error:
-            return None
+    def _enqueue(self, kind: str, entries: list[dict]) -> None:
+        # Consecutive calls of the same kind share one API call; a change
+        # of kind starts a new one so the calls keep their order
+        queue = self._batch_queue
 
+        if queue and queue[-1][0] == kind:
+            queue[-1][1].extend(entries)
+        else:
+            queue.append((kind, list(entries)))
 
-    def _range_to_grid_range(self, range: str, sheetpage_id: int=None) -> dict:
 
-        def _get_column_index(range: str) -> Optional[int]:
-            find = re.findall("[A-Z]", range)
-            
-            if len(find) < 1:
-                return None
+    @property
+    def service(self) -> Resource:
+        return self._load_service()
 
-            index = 0
-            for letter in find:
-                index = index * 26 + 1 + ord(letter) - ord('A')
 
-            return (index)
+    @property
+    def _spreadsheets(self) -> Resource:
+        spreadsheets = getattr(self._thread_local, "spreadsheets", None)
 
+        if spreadsheets is None:
+            spreadsheets = self.service.spreadsheets()
+            self._thread_local.spreadsheets = spreadsheets
 
-        def _get_row_number(range: str) -> Optional[int]:
-            find = re.findall("[0-9]+", range)
-            
-            if len(find) < 1:
-                return None 
-            
-            return (int(find[0]))
+        return spreadsheets
 
 
-        if "!" in range:
-            range = range.split("!", 1)[1]
-        
-        _range_split = range.split(":", 1)
-        start = _range_split[0]
-        end = _range_split[1] if len(_range_split) > 1 else None
-        
-        start_row: Optional[int] = (_get_row_number(start) - 1)
-        start_column: Optional[int] = (_get_column_index(start) - 1)
-        end_row: Optional[int] = _get_row_number(end)
-        end_column: Optional[int] = _get_column_index(end)
+    @property
+    def _values(self) -> Resource:
+        values = getattr(self._thread_local, "values", None)
+
+        if values is None:
+            values = self._spreadsheets.values()
+            self._thread_local.values = values
+
+        return values
+
+
+    @classmethod
+    def _load_credentials(cls) -> Credentials:
+        with cls._credentials_lock:
+            creds = cls._credentials
+
+            if creds and creds.valid:
+                return creds
+
+            from google.oauth2.credentials import Credentials
+
+            if not creds:
+                try:
+                    creds = Credentials.from_authorized_user_file(
+                        'token.json', SCOPES)
+                except FileNotFoundError:
+                    creds = None
+
+            if not creds or not creds.valid:
+                if creds and creds.expired and creds.refresh_token:
+                    from google.auth.transport.requests import Request
+
+                    creds.refresh(Request())
+                else:
+                    from google_auth_oauthlib.flow import InstalledAppFlow
+
+                    flow = InstalledAppFlow.from_client_secrets_file(
+                        'client_secret.json', SCOPES)
+                    creds = flow.run_local_server(port=0)
+
+                with open('token.json', 'w') as token:
+                    token.write(creds.to_json())
+
+            cls._credentials = creds
+            return creds
+
+
+    def _load_service(self) -> Optional[Resource]:
+        service = getattr(self._thread_local, "service", None)
+
+        if service is not None:
+            return service
+
+        from googleapiclient.discovery import build
+
+        creds = self._load_credentials()
+
+        try:
+            service = build(
+                'sheets', 'v4', credentials=creds,
+                static_discovery=True, cache_discovery=False
+            )
+        except HttpError as error:
+            return None
+
+        self._thread_local.service = service
+        return service
+
+
+    def _range_to_grid_range(self, range: str, sheetpage_id: int=None) -> dict:
+        start_row, start_column, end_row, end_column = _parse_range(range)
         
         result = {
-            "sheetId": sheetpage_id
+            "sheetId": sheetpage_id,
+            "startRowIndex": start_row,
+            "startColumnIndex": start_column
         }
-        
-        if start_row is not None:
-            result["startRowIndex"] = start_row
-        
-        if start_column is not None:
-            result["startColumnIndex"] = start_column
 
         if end_row is not None:
             result["endRowIndex"] = end_row
@@ -112,11 +214,17 @@ class GoogleSheets:
 
 
     def update(self, values: list[list], range: str) -> int:
+        # Inside batch() the write is queued and its cell count is not
+        # known until the block exits
+        if self._batch_queue is not None:
+            self._enqueue("values", [{"range": range, "values": values}])
+            return 0
+
         body = {
             "values": values
         }
 
-        result = self.service.spreadsheets().values().update( # type: ignore
+        result = self._values.update( # type: ignore
             spreadsheetId=self.sheet_id, range=range,
             valueInputOption="USER_ENTERED", body=body).execute()
 
@@ -124,21 +232,118 @@ class GoogleSheets:
 
 
     def sheetpage_name_by_range(self, range: str):
-        return range.split("!", 1)[0]
+        return range.partition("!")[0]
+
+
+    def _load_sheetpage_ids(self) -> None:
+        obj = self._spreadsheets.get(
+            spreadsheetId=self.sheet_id,
+            fields='sheets.properties(sheetId,title)'
+        ).execute(num_retries=NUM_RETRIES)
+
+        for sheet in obj.get('sheets', []):
+            properties = sheet['properties']
+            self._sheetpage_id_cache[properties['title']] = properties['sheetId']
 
 
     def sheetpage_id_by_name(self, name_range: str):
+        name = self.sheetpage_name_by_range(name_range)
+
+        if name in self._sheetpage_id_cache:
+            return self._sheetpage_id_cache[name]
+
         try:
-            obj = self.service.spreadsheets().get(
+            if not self._sheetpage_id_cache:
+                self._load_sheetpage_ids()
+
+                if name in self._sheetpage_id_cache:
+                    return self._sheetpage_id_cache[name]
+
+            # Names that are not a plain tab title (quoted names, ranges
+            # without "!") are resolved by the API itself
+            obj = self._spreadsheets.get(
                 spreadsheetId=self.sheet_id, 
-                ranges=self.sheetpage_name_by_range(name_range), 
-                fields='sheets(data(rowData(values(userEnteredFormat))),properties(sheetId))'
-            ).execute()
+                ranges=name,
+                fields='sheets.properties.sheetId'
+            ).execute(num_retries=NUM_RETRIES)
+
+            sheetpage_id = obj['sheets'][0]['properties']['sheetId']
+        except HttpError as e:
+            # 400 (unparsable range / unknown tab) and 404 are real misses;
+            # auth errors and retried-out 429/5xx must not look like one
+            if e.resp.status in (400, 404):
+                return None
 
-            return obj['sheets'][0]['properties']['sheetId']
-        except:
+            raise
+        except (KeyError, IndexError):
             return None
 
+        self._sheetpage_id_cache[name] = sheetpage_id
+        return sheetpage_id
+
+
+    def clear_sheetpage_id_cache(self) -> None:
+        self._sheetpage_id_cache.clear()
+
+
+    def _execute_batch_update(self, requests: list[dict]) -> bool:
+        if self._batch_queue is not None:
+            self._enqueue("requests", requests)
+            return True
+
+        try:
+            self._spreadsheets.batchUpdate(
+                spreadsheetId=self.sheet_id, body={"requests": requests}
+            ).execute()
+            return True
+        except HttpError as e:
+            logger.warning("batchUpdate failed: %s", e)
+            return False
+
+
+    @contextmanager
+    def batch(self) -> Iterator["GoogleSheets"]:
+        # Value writes and requests queued inside the block are sent on
+        # exit, in the order they were made: each run of consecutive
+        # update() calls goes out as one values.batchUpdate and each run
+        # of formatting requests as one batchUpdate. Nothing is sent if
+        # the block raises. Every call is attempted, and if any fails the
+        # first HttpError is raised once all have run (queued
+        # update/add_border calls already returned, so this is the only
+        # error signal the caller gets)
+        if self._batch_queue is not None:
+            yield self
+            return
+
+        self._batch_queue = []
+        try:
+            yield self
+            queue = self._batch_queue
+        finally:
+            self._batch_queue = None
+
+        errors: list[HttpError] = []
+
+        for kind, entries in queue:
+            try:
+                if kind == "values":
+                    self._values.batchUpdate( # type: ignore
+                        spreadsheetId=self.sheet_id,
+                        body={"valueInputOption": "USER_ENTERED", "data": entries}
+                    ).execute()
+                else:
+                    self._spreadsheets.batchUpdate(
+                        spreadsheetId=self.sheet_id, body={"requests": entries}
+                    ).execute()
+            except HttpError as e:
+                errors.append(e)
+
+        for error in errors[1:]:
+            logger.warning("batch flush also failed: %s", error)
+
+        if errors:
+            raise errors[0]
+
 
     def add_border(
         self, 
@@ -146,77 +351,72 @@ class GoogleSheets:
         each_cell: bool = True,
         style: BorderStyle = BorderStyle.SOLID
     ) -> bool:
-        def _execute_spreadsheets(body: dict):
-            try:
-                self.service.spreadsheets().batchUpdate(
-                    spreadsheetId=self.sheet_id, body=body
-                ).execute() 
-                return True
-            except Exception as e:
-                print(e)
-                return False
-
-        _range: dict = self._range_to_grid_range(
-            _range, self.sheetpage_id_by_name(_range)
-        )
+        # API errors (the sheet id lookup or the batchUpdate) are logged
+        # and reported as False; inside batch() the request is only
+        # queued, and a failed send raises when the block exits
+        try:
+            sheetpage_id = self.sheetpage_id_by_name(_range)
+        except HttpError as e:
+            logger.warning("add_border failed to resolve sheet id: %s", e)
+            return False
 
-        _borders = {
-            "top": {
-                "style": style.value
-            },
-            "bottom": {
-                "style": style.value
-            },
-            "left": {
-                "style": style.value
-            },
-            "right": {
-                "style": style.value
-            }
+        _range: dict = self._range_to_grid_range(_range, sheetpage_id)
+
+        _border_style = {
+            "style": style.value
         }
 
-        body = {
-            "requests": [
-                {
-                    "updateBorders": {
-                        "range": _range,
-                        **_borders
-                    }
-                }
-            ]
+        _borders = {
+            "top": _border_style,
+            "bottom": _border_style,
+            "left": _border_style,
+            "right": _border_style
         }
 
         if each_cell:
-            body = {
-                "requests": [
-                    {
-                        "repeatCell": {
-                            "range": _range,
-                            "cell": {
-                                "userEnteredFormat": {
-                                    "borders": {**_borders}
-                                }
-                            },
-                            "fields": "userEnteredFormat"
+            request = {
+                "repeatCell": {
+                    "range": _range,
+                    "cell": {
+                        "userEnteredFormat": {
+                            "borders": _borders
                         }
-                    }
-                ]
+                    },
+                    "fields": "userEnteredFormat"
+                }
+            }
+        else:
+            request = {
+                "updateBorders": {
+                    "range": _range,
+                    **_borders
+                }
             }
 
-        return _execute_spreadsheets(body)
+        return self._execute_batch_update([request])
 
 
     def select(self, range: str):
-        result = self.service.spreadsheets().values().get( # type: ignore
+        result = self._values.get( # type: ignore
             spreadsheetId=self.sheet_id, range=range).execute()
         rows = result.get('values', [])
         
         return rows
 
+
+    def select_many(self, ranges: list[str]) -> list[list[list]]:
+        result = self._values.batchGet( # type: ignore
+            spreadsheetId=self.sheet_id, ranges=ranges).execute()
+
+        return [
+            value_range.get('values', [])
+            for value_range in result.get('valueRanges', [])
+        ]
+
     
     @staticmethod
     def login():
-        GoogleSheets("")
+        GoogleSheets("").service
 
 
 
@@ -232,7 +432,10 @@ if __name__ == '__main__':
         ["Mais", "Um Teste"]
     ]
 
-    print(gs.update(data, RANGE))
+    with gs.batch():
+        gs.update(data, RANGE)
+        gs.add_border(f"{RANGE}{len(data)+1}", each_cell=True)
+
     print(gs.sheetpage_id_by_name(RANGE))
-    print(gs.add_border(f"{RANGE}{len(data)+1}", each_cell=True))
     print(gs.select(RANGE))
+    print(gs.select_many([RANGE, "Página1!A1"]))